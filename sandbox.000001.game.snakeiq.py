@@ -1,6 +1,19 @@
-from collections import namedtuple
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from array import array
+import numpy as np
+import weakref
 import pygame
+import multiprocessing
+import atexit
+import itertools
+import subprocess
+import hashlib
+import json
+import sys
+import os
 import random
+import struct
 import enum
 import time
 
@@ -22,6 +35,8 @@ import time
 
 
 Coordinate = namedtuple('Coordinate', 'lat, lng')
+Snapshot = namedtuple('Snapshot', 'ticks, game_over, reason, rng, snakes, foods, owners, free, slot, waiting')
+Death = namedtuple('Death', 'tick, victim, killer, cause')  # killer is None for a boundary, the victim for itself
 
 
 class Orientation(enum.Enum):
@@ -35,6 +50,7 @@ WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
 LIGHT_BLUE = (0, 200, 255)
 LIGHT_YELLOW = (255, 231, 82)
+DARK_GREY = (40, 40, 40)
 
 ROYAL_PURPLE = "#59467B"
 ROYAL_MAHOGANY = "#653420"
@@ -47,28 +63,216 @@ BLOCK_SIZE = 20
 FONT_SIZE = 20
 FPS = 10
 
-pygame.init()
-font = pygame.font.Font(None, FONT_SIZE)
-
 
 class Snake:
     # merging object criteria (i.e., location) with object worthiness (i.e., score)
+    __slots__ = ("elements", "orientation", "growing", "brain", "score", "born_ts", "alive")
 
-    def __init__(self, at=None, length=3):
+    def __init__(self, at=None, length=3, brain=None):
         if at is None : at = (40+length*BLOCK_SIZE, 40)
-        self.elements = [Coordinate(at[0]-i*BLOCK_SIZE, at[1]) for i in range(length)]
+        # head first; a deque so that advancing (appendleft the head, pop the tail) and growing (skip the pop) are O(1)
+        # however long the snake is, while draw and the collision code still iterate the segments lazily in order
+        self.elements = deque(Coordinate(at[0]-i*BLOCK_SIZE, at[1]) for i in range(length))
         self.orientation = Orientation.EAST
         self.growing = 0
+        self.brain = brain  # None is a human at the keyboard; any number of snakes may share one Brain
 
         self.score = length
         self.born_ts = time.time()
+        self.alive = True  # only arena games have dead snakes, which keep their index but have no elements
 
     def draw(self, screen):
-        body = Square()
-        for c in self.elements: screen.blit(body.image, (c.lat, c.lng))
+        body = square()
+        screen.blits([(body, (c.lat, c.lng)) for c in self.elements], doreturn=False)
+
+
+class Brain:
+    # the decision half of a snake: each tick the engine hands every brain the observations of all the snakes it drives
+    # as one (n, len(OBSERVATION)) int array and expects n Orientation values back (0 keeps going), so that a policy
+    # model shared by hundreds of snakes is evaluated once per tick as a batch instead of once per snake; scripted brains
+    # that need the whole board rather than an observation override think() instead
+
+    def think(self, game, members):
+        return self.decide(game.observe(members))
+
+    def decide(self, observations):
+        raise NotImplementedError
+
+    def reset(self, seed=None):
+        # called before each game a brain is reused for (as the farm does), so that the game's seed alone decides any
+        # randomness of the brain too; brains without randomness or memory have nothing to do
+        pass
+
+    def fork(self, game, clone):
+        # called when game is cloned, for brains that remember something per game to remember it for the clone too
+        pass
+
+
+OBSERVATION = ("x", "y", "orientation", "food_dx", "food_dy", "free_east", "free_west", "free_north", "free_south")
+
+
+class RandomBrain(Brain):
+    # keeps going, wanders now and then, and turns to a random free side when the cell ahead is taken; a baseline
+
+    def __init__(self, seed=None, wander=0.1):
+        self.rng, self.wander = np.random.default_rng(seed), wander
+
+    def reset(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+
+    def decide(self, observations):
+        n = len(observations)
+        free = observations[:, 5:9].astype(bool)
+        ahead = free[np.arange(n), observations[:, 2]-1]
+        choice = np.argmax(self.rng.random(free.shape)*free, axis=1)+1
+        keep = ahead & (self.rng.random(n) >= self.wander) | ~free.any(axis=1)
+        return np.where(keep, 0, choice)
+
+
+class PathBrain(Brain):
+    # a scripted baseline and opponent: the shortest path over the occupancy grid to the nearest food, or, when no food
+    # can be reached, to the cell its own tail is leaving (tail chasing keeps a boxed-in snake alive until a way out
+    # opens, or else any free cell). The path is cached per snake and followed tick after tick, since from one tick to
+    # the next only heads and tails move: tails only ever free cells, so a path stays good until the food it heads for
+    # is eaten or a head moves into its next cell, which is checked in O(1) every tick. Snakes whose path went bad
+    # replan from one breadth-first search run backwards from every food at once, shared by all of them, so a board full
+    # of snakes chasing the same food costs one full-board search per tick in which any of them replans, instead of one
+    # per snake per tick.
+
+    def __init__(self):
+        # per game, since one brain plays many games in turn in the farm and side by side with clones in a lookahead:
+        # game -> snake index -> (deque of flat cell indices still to visit, flat index of the food or None)
+        self.paths = weakref.WeakKeyDictionary()
+        self.searches = 0
+
+    def think(self, game, members):
+        grid, turns, field, paths = game.grid, [], None, self.paths.setdefault(game, {})
+        for s_i in members:
+            snake = game.snakes[s_i]
+            head = grid.index(snake.elements[0])
+            path, food = paths.get(s_i, (None, None))
+            if not path or grid.owners[path[0]] != NOBODY or abs(path[0]-head) not in (1, grid.columns) or \
+                    food is not None and Coordinate(food % grid.columns*grid.block, food//grid.columns*grid.block) \
+                    not in game.food_at:
+                # the food is gone once no food lies at its cell (eaten by any snake), a respawned snake is elsewhere
+                if field is None: field = self.search(grid, [grid.index(f.at) for f in game.foods])
+                path = self.follow(grid, field, head)
+                food = path[-1] if path else None
+                if not path: path = self.search(grid, [head], grid.index(snake.elements[-1]))
+                if not path: path = deque(self.neighbours(grid, head, lambda j: grid.owners[j] == NOBODY)[:1])
+                paths[s_i] = (path, food)
+            turns.append(self.toward(head, path.popleft()) if path else 0)
+        return turns
+
+    def fork(self, game, clone):
+        if game not in self.paths: return
+        self.paths[clone] = {s_i: (deque(path), food) for s_i, (path, food) in self.paths[game].items()}
+
+    def search(self, grid, starts, goal=None):
+        # breadth-first over free cells from starts; with a goal, the path to it (the goal may be occupied, as a tail
+        # about to leave is), without one, every reachable cell's parent one step closer to the nearest start
+        self.searches += 1
+        owners, columns, n = grid.owners, grid.columns, len(grid.owners)
+        parent, frontier = {i: i for i in starts}, list(starts)
+        while frontier:
+            reached = []
+            for i in frontier:
+                x = i % columns
+                for j in (i+1 if x < columns-1 else -1, i-1 if x > 0 else -1, i-columns, i+columns):
+                    if j < 0 or j >= n or j in parent: continue
+                    if j == goal:
+                        path = deque([j])
+                        while parent[i] != i: path.appendleft(i); i = parent[i]
+                        return path
+                    if owners[j] != NOBODY: continue
+                    parent[j] = i
+                    reached.append(j)
+            frontier = reached
+        return parent if goal is None else deque()
+
+    @staticmethod
+    def follow(grid, field, head):
+        # step onto the neighbour the field reaches first (nearest the food), then walk its parents down to the food
+        steps = PathBrain.neighbours(grid, head, lambda j: j in field)
+        if not steps: return deque()
+        j, path = steps[0], deque()
+        for k in steps[1:]:  # fewest steps to a food; the walk is short next to the search it replaces
+            if PathBrain.distance(field, k) < PathBrain.distance(field, j): j = k
+        while True:
+            path.append(j)
+            if field[j] == j: return path
+            j = field[j]
+
+    @staticmethod
+    def neighbours(grid, i, keep):
+        x, columns = i % grid.columns, grid.columns
+        return [j for j in (i+1 if x < columns-1 else -1, i-1 if x > 0 else -1, i-columns, i+columns)
+                if len(grid.owners) > j >= 0 and keep(j)]
+
+    @staticmethod
+    def distance(field, j):
+        d = 0
+        while field[j] != j: j, d = field[j], d+1
+        return d
+
+    @staticmethod
+    def toward(i, j):
+        if j == i+1: return Orientation.EAST.value
+        if j == i-1: return Orientation.WEST.value
+        return Orientation.NORTH.value if j < i else Orientation.SOUTH.value
+
+
+# keys to (snake index, orientation); player 0 on the arrows, player 1 on WASD, player 2 on IJKL
+BINDINGS = {pygame.K_RIGHT: (0, Orientation.EAST), pygame.K_LEFT: (0, Orientation.WEST),
+            pygame.K_UP: (0, Orientation.NORTH), pygame.K_DOWN: (0, Orientation.SOUTH),
+            pygame.K_d: (1, Orientation.EAST), pygame.K_a: (1, Orientation.WEST),
+            pygame.K_w: (1, Orientation.NORTH), pygame.K_s: (1, Orientation.SOUTH),
+            pygame.K_l: (2, Orientation.EAST), pygame.K_j: (2, Orientation.WEST),
+            pygame.K_i: (2, Orientation.NORTH), pygame.K_k: (2, Orientation.SOUTH)}
+REVERSE = {Orientation.EAST: Orientation.WEST, Orientation.WEST: Orientation.EAST,
+           Orientation.NORTH: Orientation.SOUTH, Orientation.SOUTH: Orientation.NORTH}
+
+
+class InputQueue:
+    # every keypress of every player, timestamped and queued per snake, instead of whichever key happened to be read
+    # last before the tick; the game loop polls between ticks as well as on them, so that at a low FPS a quick
+    # up-then-left is two turns on two ticks rather than one lost keypress. Each tick consumes exactly one turn per
+    # snake, skipping queued keys that would not turn it (the same direction, or a reversal that would stupidly crash it
+    # into itself), and the delay from keypress to the tick that moved the snake is kept in self.latencies.
+
+    def __init__(self, bindings=BINDINGS, depth=3):
+        self.bindings, self.depth = bindings, depth  # deeper queues than a few turns only make the snake feel late
+        self.queues = {}
+        self.latencies = deque(maxlen=4096)
+
+    def poll(self):
+        now = time.perf_counter()
+        for e in pygame.event.get():
+            if e.type == pygame.QUIT:
+                pygame.quit()
+                quit()
+            if e.type == pygame.KEYDOWN and e.key in self.bindings:
+                s_i, orientation = self.bindings[e.key]
+                queue = self.queues.setdefault(s_i, deque())
+                if len(queue) < self.depth: queue.append((now, orientation))
+
+    def pop(self, s_i, orientation):
+        queue = self.queues.get(s_i)
+        while queue:
+            pressed, turn = queue.popleft()
+            if turn != orientation and turn != REVERSE[orientation]:
+                self.latencies.append(time.perf_counter()-pressed)
+                return turn
+        return None
+
+    def latency(self):
+        ms = np.array(self.latencies)*1e3
+        return dict(n=len(ms), mean=float(ms.mean()), p99=float(np.percentile(ms, 99)), max=float(ms.max())) \
+            if len(ms) else dict(n=0)
 
 
 class Food:
+    __slots__ = ("at", "value")
 
     def __init__(self, at=None, value=1):
         if at is None: at = Coordinate(BLOCK_SIZE*random.randint(0, DISPLAY_SIZE[0]//BLOCK_SIZE-1),
@@ -77,43 +281,309 @@ class Food:
         self.value = value
 
     def draw(self, screen):
-        screen.blit(Square(fill=LIGHT_YELLOW).image, (self.at.lat, self.at.lng))
+        screen.blit(square(fill=LIGHT_YELLOW), (self.at.lat, self.at.lng))
+
+
+NOBODY, OUTSIDE = -1, -2
+REASONS = dict(boundary="{victim} snake crashed into a boundary.", itself="{victim} snake crashed into itself.",
+               body="{victim} snake and {killer} snake crashed.",
+               head_on="{victim} snake and {killer} snake crashed head-on.")  # game over reasons by cause of death
+
+
+class FreeCells:
+    # every cell index not covered by a snake or a food, in a swap-remove array plus each cell's slot in that array, so
+    # that taking, returning and uniformly sampling a free cell are all O(1) even when 99% of the board is occupied,
+    # where retrying random cells until one is free would take a hundred attempts on average and forever when full
+
+    def __init__(self, n):
+        self.cells = array('i', range(n))
+        self.slot = array('i', range(n))  # position of each cell in self.cells, -1 when the cell is not free
+
+    def __len__(self):
+        return len(self.cells)
+
+    def remove(self, i):
+        p = self.slot[i]
+        if p < 0: return
+        last = self.cells.pop()
+        if last != i: self.cells[p], self.slot[last] = last, p
+        self.slot[i] = -1
+
+    def add(self, i):
+        if self.slot[i] >= 0: return
+        self.slot[i] = len(self.cells)
+        self.cells.append(i)
+
+    def sample(self, rng=random):
+        return self.cells[rng.randrange(len(self.cells))] if self.cells else None
+
+
+class OccupancyGrid:
+    # the owner (snake index) of every cell in one flat array, kept in sync on every head insert and tail pop, so that
+    # asking whether a head is off the board, inside its own body, or inside another snake is one lookup per snake no
+    # matter how long the snakes are, instead of scanning every body segment of every snake on every tick
+
+    def __init__(self, size=DISPLAY_SIZE, block=BLOCK_SIZE):
+        self.columns, self.rows, self.block = size[0]//block, size[1]//block, block
+        self.owners = array('i', [NOBODY])*(self.columns*self.rows)
+        self.free = FreeCells(self.columns*self.rows)
+
+    def index(self, c):
+        x, y = c.lat//self.block, c.lng//self.block
+        if not self.columns > x >= 0 or not self.rows > y >= 0: return None
+        return y*self.columns+x
+
+    def owner(self, c):
+        i = self.index(c)
+        return OUTSIDE if i is None else self.owners[i]
+
+    def claim(self, c, owner):
+        i = self.index(c)
+        self.owners[i] = owner
+        self.free.remove(i)
+
+    def release(self, c):
+        i = self.index(c)
+        self.owners[i] = NOBODY
+        self.free.add(i)  # food never lies under a body, so a released cell is free
+
+    def reserve(self, c):
+        self.free.remove(self.index(c))  # for food, which occupies a cell without owning it
+
+    def sample_free(self, rng=random):
+        i = self.free.sample(rng)
+        return None if i is None else Coordinate(i % self.columns*self.block, i//self.columns*self.block)
 
 
 class Game:
 
-    def __init__(self):
-        self.screen = pygame.display.set_mode(DISPLAY_SIZE)
-        pygame.display.set_caption(DISPLAY_NAME)
-        self.clock = pygame.time.Clock()
+    def __init__(self, headless=False, tick_rate=FPS, render_every=1, seed=None, record=False, snakes=None,
+                 size=DISPLAY_SIZE, profiler=None, bindings=BINDINGS, viewport=None, arena=False, respawn=True,
+                 background=None, deaths=4096):
+        # tick_rate is simulation ticks per second (None runs as fast as possible); a frame is rendered every
+        # render_every ticks (0 never renders). headless never opens a display, loads a font or reads keyboard events,
+        # so that the engine starts in milliseconds on machines without a screen. Every random choice is drawn from
+        # self.rng, so the seed plus the stream of turns fully determines a game, which record=True logs in self.log.
+        # arena=True never stops the world for a crash: crashed snakes are taken off the board and, with respawn, put
+        # back at a random free spot under the same index; every death is appended to self.deaths in either mode, which
+        # keeps only the last `deaths` of them (None for all) as a crowded arena dies dozens of times a tick for hours,
+        # while self.died counts every death since the start.
+        self.seed = random.getrandbits(63) if seed is None else seed
+        self.rng = random.Random(self.seed)
+        self.size = size
+        self.viewport = size if viewport is None else viewport  # a world larger than the viewport is seen by a camera
+        self.camera, self.follow = Coordinate(0, 0), 0  # top left of the viewport in the world, and the snake it follows
+        self.background = background  # a TileLayer of the map under the game, or None for black
+        self.profiler = profiler  # a TickProfiler to time every phase of every tick, or None for no instrumentation
+        self.headless = headless
+        self.tick_rate = tick_rate
+        self.render_every = 0 if headless else render_every
+        if not headless:
+            pygame.init()
+            self.screen = pygame.display.set_mode(self.viewport)
+            pygame.display.set_caption(DISPLAY_NAME)
+            self.font = pygame.font.Font(None, FONT_SIZE)
+            self.text = TextCache(self.font)
+        self.inputs = None if headless else InputQueue(bindings)
         self.frame = []
+        self.ticks = 0
         self.game_over = False
         self.reason = None
+        self.arena, self.respawn = arena, respawn
+        self.deaths = deque(maxlen=deaths)  # the latest Death(tick, victim, killer, cause) in the order they happened
+        self.died = 0
+        self.waiting = []  # dead snakes to respawn, in the order they died
+
+        self.snakes = [Snake()] if snakes is None else snakes
+        self.log = ReplayLog(self.seed, self.snakes, size, arena, respawn) if record else None
+        self.grid = OccupancyGrid(size)
+        for s_i, snake in enumerate(self.snakes):
+            for c in snake.elements: self.grid.claim(c, s_i)
+        self.foods = [self.spawn_food()]
+        self.food_at = {food.at: f_i for f_i, food in enumerate(self.foods)}
+
+        self.drawn = False  # the first frame is drawn whole; after that only the cells in self.dirty are redrawn
+        self.dirty = []
+        self.hud = {}  # snake index -> (text, rect) of its score label on screen
+
+    def loop(self, max_ticks=None):
+        # fixed timestep: the rules advance one tick per 1/tick_rate seconds of wall clock whatever rendering costs; when
+        # the simulation falls behind it catches up tick after tick and skips the frames in between, since the dirty
+        # cells accumulate until the next frame that is drawn; a resync after a second behind avoids a spiral of death
+        next_tick = time.perf_counter()
+        while not self.game_over and (max_ticks is None or self.ticks < max_ticks):
+            if self.tick_rate: next_tick += 1/self.tick_rate
+            due = self.render_every and (self.ticks+1) % self.render_every == 0
+            behind = self.tick_rate and time.perf_counter() > next_tick
+            if due and behind and self.profiler: self.profiler.dropped += 1
+            self.step(render=due and not behind)
+            if not self.tick_rate: continue
+            wait = next_tick-time.perf_counter()
+            while wait > 0:  # keep reading keys while waiting, so that none waits for the next tick to be timestamped
+                if self.inputs: self.inputs.poll()
+                time.sleep(min(wait, 0.002))
+                wait = next_tick-time.perf_counter()
+            if wait < -1.0: next_tick = time.perf_counter()
+        if self.log and not self.game_over: self.log.checkpoint(self.ticks, self.state_hash())  # so replays end here too
 
-        self.snakes = [Snake()]
-        self.foods = [Food()]
+    def step(self, render=False):
+        if self.profiler: return self.profiler.step(self, render)
+        self.interpret_events()
+        self.update_state()
+        self.interpret_interactions()
+        self.end_tick()
+        if render: self.update_ui()
 
-    def loop(self):
-        while not self.game_over:
-            self.interpret_events()
-            self.update_state()
-            self.interpret_interactions()
-            self.update_ui()
+    def end_tick(self):
+        self.ticks += 1
+        if not self.render_every: self.dirty.clear()  # nothing will ever draw them
+        if self.log and (self.game_over or self.ticks % self.log.checkpoint_every == 0):
+            self.log.checkpoint(self.ticks, self.state_hash())
+
+    def turn(self, s_i, orientation):
+        # every change of orientation, whether from a keypress or an AI, goes through here so that it can be recorded
+        if self.snakes[s_i].orientation == orientation: return
+        self.snakes[s_i].orientation = orientation
+        if self.log: self.log.turn(self.ticks, s_i, orientation)
+
+    def snapshot(self):
+        # the whole state as immutable tuples (bodies are tuples of the very same Coordinate objects) and flat arrays,
+        # with no pygame objects in it; a snapshot is never modified, so one can be restored into any number of games
+        return Snapshot(self.ticks, self.game_over, self.reason, self.rng.getstate(),
+                        tuple((tuple(s.elements), s.orientation, s.growing, s.score, s.alive) for s in self.snakes),
+                        tuple((f.at, f.value) for f in self.foods),
+                        self.grid.owners[:], self.grid.free.cells[:], self.grid.free.slot[:], tuple(self.waiting))
+
+    def restore(self, snapshot):
+        self.ticks, self.game_over, self.reason = snapshot.ticks, snapshot.game_over, snapshot.reason
+        self.rng.setstate(snapshot.rng)
+        while len(self.snakes) < len(snapshot.snakes): self.snakes.append(Snake())
+        del self.snakes[len(snapshot.snakes):]
+        for snake, (elements, orientation, growing, score, alive) in zip(self.snakes, snapshot.snakes):
+            snake.elements, snake.orientation, snake.growing, snake.score = deque(elements), orientation, growing, score
+            snake.alive = alive
+        self.waiting = list(snapshot.waiting)
+        self.foods = [Food(at, value) for at, value in snapshot.foods]
+        self.food_at = {food.at: f_i for f_i, food in enumerate(self.foods)}
+        self.grid.owners, self.grid.free.cells, self.grid.free.slot = \
+            snapshot.owners[:], snapshot.free[:], snapshot.slot[:]  # flat copies are a memcpy each
+        self.drawn = False
+        self.dirty.clear()
+
+    def clone(self, snapshot=None):
+        # a headless, unrecorded copy to play lookahead moves on, which never touches the original or a display; built
+        # with __new__ rather than __init__, which would lay out a whole fresh board (the grid, its free cells, a snake
+        # and a food) only for restore to overwrite it, so that a clone costs no more than a restore. Its snakes keep
+        # the brains of the original's, the very same objects, so AI opponents go on thinking in a lookahead; a brain
+        # with memory per game (PathBrain) forks it for the clone, while one with randomness of its own (RandomBrain)
+        # draws from one generator for both games, so such a clone plays like its original but not move for move
+        game = Game.__new__(Game)
+        game.seed, game.size, game.viewport = self.seed, self.size, self.size
+        game.rng = random.Random.__new__(random.Random)  # unseeded, as restore sets its state
+        game.camera, game.follow, game.background, game.profiler = Coordinate(0, 0), 0, None, None
+        game.headless, game.tick_rate, game.render_every, game.inputs, game.log = True, None, 0, None, None
+        game.arena, game.respawn = self.arena, self.respawn
+        game.deaths, game.died = deque(maxlen=self.deaths.maxlen), 0
+        game.frame, game.snakes, game.drawn, game.dirty, game.hud = [], [], False, [], {}
+        game.grid = OccupancyGrid.__new__(OccupancyGrid)
+        game.grid.columns, game.grid.rows, game.grid.block = self.grid.columns, self.grid.rows, self.grid.block
+        game.grid.free = FreeCells.__new__(FreeCells)
+        game.restore(self.snapshot() if snapshot is None else snapshot)
+        for snake, original in zip(game.snakes, self.snakes): snake.brain = original.brain
+        for brain in {snake.brain for snake in game.snakes if snake.brain is not None}: brain.fork(self, game)
+        return game
+
+    def state_hash(self):
+        state = array('i', [self.ticks])
+        for snake in self.snakes:
+            state.extend((snake.alive, snake.orientation.value, snake.growing, snake.score, len(snake.elements)))
+            for c in snake.elements: state.extend(c)
+        for food in self.foods: state.extend((food.value, *food.at))
+        return hashlib.blake2b(state.tobytes(), digest_size=8).digest()
 
     def update_ui(self):
-        self.screen.fill(BLACK)
-        for snake in self.snakes: snake.draw(self.screen)
-        for food in self.foods: food.draw(self.screen)
+        # dirty rectangles: a tick only changes a handful of cells (each new head, each popped tail, each moved food),
+        # so only those cells, plus the score labels they touch or whose score changed, are redrawn and pushed to the
+        # display; the cost of a frame then follows the number of changes rather than the size of the board or the
+        # number of elements on it
+        if self.viewport != self.size: return self.update_viewport()
+        if self.background is not None and self.background.poll(): self.drawn = False  # map tiles arrived
+        if not self.drawn:
+            self.draw_background()
+            for snake in self.snakes: snake.draw(self.screen)
+            for food in self.foods: food.draw(self.screen)
+            self.hud.clear()
+            self.draw_hud()
+            pygame.display.flip()
+            self.drawn = True
+        else:
+            dirty = set(self.dirty)
+            rects = [self.draw_cell(c) for c in dirty]
+            pygame.display.update(rects+self.draw_hud(dirty))
+        self.dirty.clear()
 
-        for i, snake in enumerate(self.snakes):
-            text = font.render(f"{i} Snake: {snake.score}", True, WHITE)
-            self.screen.blit(text, (0, BLOCK_SIZE*i))
+    def update_viewport(self):
+        # large worlds: the camera moves with the snake it follows, so the whole viewport changes every tick, but only
+        # what lies inside it is drawn; the occupied cells come from a zero-copy 2D view of the visible window of the
+        # occupancy grid, so a frame costs the same on a board of millions of cells as on one the size of the screen
+        snake, (vw, vh) = self.snakes[self.follow], self.viewport
+        if snake.alive:  # the camera of a dead arena snake stays where it died
+            head = snake.elements[0]
+            self.camera = Coordinate(min(max(head.lat-vw//2, 0), self.size[0]-vw)//BLOCK_SIZE*BLOCK_SIZE,
+                                     min(max(head.lng-vh//2, 0), self.size[1]-vh)//BLOCK_SIZE*BLOCK_SIZE)
+        left, top = self.camera
+        x0, y0 = left//BLOCK_SIZE, top//BLOCK_SIZE
+        owners = np.frombuffer(self.grid.owners, dtype=np.int32).reshape(self.grid.rows, self.grid.columns)
+        ys, xs = np.nonzero(owners[y0:y0+vh//BLOCK_SIZE+1, x0:x0+vw//BLOCK_SIZE+1] >= 0)
+
+        self.draw_background()
+        body, food = square(), square(fill=LIGHT_YELLOW)
+        self.screen.blits([(body, (x*BLOCK_SIZE, y*BLOCK_SIZE)) for x, y in zip(xs.tolist(), ys.tolist())],
+                          doreturn=False)
+        self.screen.blits([(food, (f.at.lat-left, f.at.lng-top)) for f in self.foods
+                           if vw > f.at.lat-left >= 0 and vh > f.at.lng-top >= 0], doreturn=False)
+        self.hud.clear()
+        self.draw_hud()
         pygame.display.flip()
-        self.clock.tick(FPS)
+        self.drawn = True
+        self.dirty.clear()
+
+    def draw_cell(self, c):
+        # food is drawn over bodies, as in a full redraw where foods are drawn after snakes
+        rect = pygame.Rect(c.lat, c.lng, BLOCK_SIZE, BLOCK_SIZE)
+        if c in self.food_at: self.screen.blit(square(fill=LIGHT_YELLOW), rect)
+        elif self.grid.owner(c) >= 0: self.screen.blit(square(), rect)
+        elif self.background is not None: self.background.draw(self.screen, self.camera, rect)
+        else: self.screen.fill(BLACK, rect)
+        return rect
+
+    def draw_background(self):
+        if self.background is None: self.screen.fill(BLACK)
+        else: self.background.draw(self.screen, self.camera)
+
+    def draw_hud(self, dirty=()):
+        # a compositor over the score labels, one per row (FONT_SIZE fits in a cell) for as many snakes as there are
+        # rows on screen: a label is blitted again only when its text changed or a redrawn cell covers part of it, over
+        # the freshly redrawn cells under it, and its Surface comes from the text cache, so that an unchanged score is
+        # never rendered twice however many frames it stays on screen
+        left = {}  # row -> the leftmost cell redrawn in it
+        for c in dirty:
+            if c.lat < left.get(c.lng//BLOCK_SIZE, c.lat+1): left[c.lng//BLOCK_SIZE] = c.lat
+        rects = []
+        for i, snake in enumerate(self.snakes[:self.viewport[1]//BLOCK_SIZE]):
+            text, (old, rect) = f"{i} Snake: {snake.score}", self.hud.get(i, (None, None))
+            if text == old and left.get(i, rect.right) >= rect.right: continue
+            if rect: rects += [self.draw_cell(Coordinate(x, y)) for x in range(0, rect.right, BLOCK_SIZE)
+                               for y in range(rect.top//BLOCK_SIZE*BLOCK_SIZE, rect.bottom, BLOCK_SIZE)]
+            rect = self.screen.blit(self.text.render(text), (0, BLOCK_SIZE*i))
+            self.hud[i] = (text, rect)
+            rects.append(rect)
+        return rects
 
     def update_state(self):
         # passive
-        for snake in self.snakes:
+        for s_i, snake in enumerate(self.snakes):
+            if not snake.alive: continue
             head_is = snake.elements[0]
             match snake.orientation:
                 case Orientation.EAST:
@@ -125,58 +595,186 @@ class Game:
                 case Orientation.SOUTH:
                     head_to = Coordinate(head_is.lat, head_is.lng + BLOCK_SIZE)
                 case _: raise RuntimeError("impossible")
-            snake.elements.insert(0, head_to)
+            snake.elements.appendleft(head_to)
+            self.dirty.append(head_to)
             if snake.growing > 0:
                 snake.growing -= 1
             else:
-                snake.elements.pop(len(snake.elements)-1)
+                tail = snake.elements.pop()
+                self.grid.release(tail)  # heads are claimed once checked
+                self.dirty.append(tail)
 
     def interpret_events(self):
-        # not asynchronous; not handling multiple snakes
+        # brains first, then one queued turn for each human snake
+        self.interpret_brains()
+        if self.headless: return
 
-        for e in pygame.event.get():
-            if e.type == pygame.QUIT:
-                pygame.quit()
-                quit()
-            if e.type == pygame.KEYDOWN:
-                snake = self.snakes[0]
-                if e.key == pygame.K_RIGHT:
-                    if snake.orientation != Orientation.WEST:  # prevent humans from stupidly crashing into self
-                        self.snakes[0].orientation = Orientation.EAST
-                elif e.key == pygame.K_LEFT:
-                    if snake.orientation != Orientation.EAST:  # prevent humans from stupidly crashing into self
-                        self.snakes[0].orientation = Orientation.WEST
-                elif e.key == pygame.K_UP:
-                    if snake.orientation != Orientation.SOUTH:  # prevent humans from stupidly crashing into self
-                        self.snakes[0].orientation = Orientation.NORTH
-                elif e.key == pygame.K_DOWN:
-                    if snake.orientation != Orientation.NORTH:  # prevent humans from stupidly crashing into self
-                        self.snakes[0].orientation = Orientation.SOUTH
+        self.inputs.poll()
+        for s_i in self.inputs.queues:
+            if s_i >= len(self.snakes) or self.snakes[s_i].brain is not None or not self.snakes[s_i].alive: continue
+            turn = self.inputs.pop(s_i, self.snakes[s_i].orientation)
+            if turn: self.turn(s_i, turn)
+
+    def interpret_brains(self):
+        # one think() call per brain with the batch of every snake it drives; reversals are ignored as for humans
+        batches = {}
+        for s_i, snake in enumerate(self.snakes):
+            if snake.brain is not None and snake.alive: batches.setdefault(snake.brain, []).append(s_i)
+        for brain, members in batches.items():
+            for s_i, o in zip(members, brain.think(self, members)):
+                if o and OPPOSITE[o] != self.snakes[s_i].orientation.value: self.turn(s_i, Orientation(o))
+
+    def observe(self, members):
+        observations = np.zeros((len(members), len(OBSERVATION)), dtype=np.int32)
+        for row, s_i in zip(observations, members):
+            snake = self.snakes[s_i]
+            head = snake.elements[0]
+            food = min(self.foods, key=lambda f: abs(f.at.lat-head.lat)+abs(f.at.lng-head.lng)).at
+            row[:5] = (head.lat//BLOCK_SIZE, head.lng//BLOCK_SIZE, snake.orientation.value,
+                       (food.lat-head.lat)//BLOCK_SIZE, (food.lng-head.lng)//BLOCK_SIZE)
+            row[5:] = (self.grid.owner(Coordinate(head.lat+BLOCK_SIZE, head.lng)) == NOBODY,
+                       self.grid.owner(Coordinate(head.lat-BLOCK_SIZE, head.lng)) == NOBODY,
+                       self.grid.owner(Coordinate(head.lat, head.lng-BLOCK_SIZE)) == NOBODY,
+                       self.grid.owner(Coordinate(head.lat, head.lng+BLOCK_SIZE)) == NOBODY)
+        return observations
 
     def interpret_interactions(self):
 
-        # check if collisions
+        # check if collisions, for every snake at once: every tail has already left the grid and no head has claimed its
+        # cell yet, so the outcome does not depend on the order of the snakes. A head off the board, in its own body or
+        # in any other body dies, and so does every head arriving in the same free cell as another (head-on), each death
+        # attributed to the snake it ran into; then the surviving heads claim their cells and the dead are resolved
+        grid, arriving, crashes = self.grid, {}, []
         for s_i, snake in enumerate(self.snakes):
+            if not snake.alive: continue
             head_is = snake.elements[0]
-            if not DISPLAY_SIZE[0] > head_is.lat >= 0 or not DISPLAY_SIZE[1] > head_is.lng >= 0:
-                self.game_over, self.reason = True, f"{s_i} snake crashed into a boundary."
-                return
-            if head_is in snake.elements[1:]:
-                self.game_over, self.reason = True, f"{s_i} snake crashed into itself."
-                return
-            for o_i in range(s_i+1, len(self.snakes)-1):
-                if head_is in self.snakes[o_i].elements[1:]:
-                    self.game_over, self.reason = True, f"{s_i} snake and {o_i} snake crashed."  # attribution multiplayer
-                return
+            owner = grid.owner(head_is)
+            if owner == OUTSIDE: crashes.append((s_i, None, "boundary"))
+            elif owner == s_i: crashes.append((s_i, s_i, "itself"))
+            elif owner != NOBODY: crashes.append((s_i, owner, "body"))
+            else: arriving.setdefault(head_is, []).append(s_i)
+        for head_is, members in arriving.items():
+            if len(members) == 1: grid.claim(head_is, members[0])
+            else: crashes.extend((s_i, members[s_i == members[0]], "head_on") for s_i in members)
+        for victim, killer, cause in sorted(crashes):
+            self.deaths.append(Death(self.ticks, victim, killer, cause))
+            self.died += 1
+            if self.arena: self.remove_snake(victim)
+        if crashes and not self.arena:
+            victim, killer, cause = min(crashes)
+            self.game_over, self.reason = True, REASONS[cause].format(victim=victim, killer=killer)
+            return
 
         # check if food
-        for s_i in range(len(self.snakes)):
-            head_is = self.snakes[s_i].elements[0]
-            for f_i in range(len(self.foods)):
-                if head_is == self.foods[f_i].at:
-                    self.snakes[s_i].growing += self.foods[f_i].value
-                    self.snakes[s_i].score += self.foods[f_i].value
-                    self.foods[f_i] = Food()
+        for s_i, snake in enumerate(self.snakes):
+            if not snake.alive: continue
+            f_i = self.food_at.pop(snake.elements[0], None)
+            if f_i is not None:
+                snake.growing += self.foods[f_i].value
+                snake.score += self.foods[f_i].value
+                food = self.spawn_food()
+                if food is None:
+                    self.game_over, self.reason = True, "the board is full."
+                    return
+                self.foods[f_i] = food
+                self.food_at[food.at] = f_i
+                self.dirty.append(food.at)
+
+        if self.waiting: self.waiting = [s_i for s_i in self.waiting if not self.spawn_snake(s_i)]
+
+    def remove_snake(self, s_i):
+        # the body leaves the grid at once (the head never claimed its cell) while the snake keeps its index, so that
+        # brains, replay logs and the HUD keep referring to the same snake across deaths and respawns
+        snake = self.snakes[s_i]
+        for c in itertools.islice(snake.elements, 1, None):
+            self.grid.release(c)
+            self.dirty.append(c)
+        snake.elements.clear()
+        snake.alive = False
+        if self.respawn: self.waiting.append(s_i)
+
+    def spawn_snake(self, s_i, length=3, tries=8):
+        # a random free cell with room for the body west of it, facing east as at the start; False when none was found
+        # in a few draws, and the snake waits for the next tick
+        for _ in range(tries):
+            at = self.grid.sample_free(self.rng)
+            if at is None: return False
+            cells = [Coordinate(at.lat-i*BLOCK_SIZE, at.lng) for i in range(length)]
+            if all(self.grid.owner(c) == NOBODY and c not in self.food_at for c in cells): break
+        else: return False
+        snake = self.snakes[s_i]
+        snake.elements, snake.orientation, snake.growing = deque(cells), Orientation.EAST, 0
+        snake.score, snake.born_ts, snake.alive = length, time.time(), True
+        for c in cells: self.grid.claim(c, s_i)
+        self.dirty.extend(cells)
+        return True
+
+    def spawn_food(self, value=1):
+        # a uniformly random cell that no snake and no other food covers; None when there is no such cell left
+        at = self.grid.sample_free(self.rng)
+        if at is None: return None
+        self.grid.reserve(at)
+        return Food(at, value)
+
+
+# A ReplayLog is everything needed to rebuild a game bit for bit: the RNG seed, the board size, the arena flags and the
+# head and length of each snake it started with in a header (brains are not replayed, their turns are; arena respawns
+# are drawn from the RNG like food), then one 7 byte record per change of orientation (tick, snake, orientation) and,
+# every checkpoint_every ticks and at the end, a record with orientation 0 followed by the 8 byte state_hash() of the
+# game at that tick. A thousand-tick game with a turn every few ticks is a couple of kilobytes. replay() reruns the log
+# headless at full speed and raises at the first checkpoint whose hash differs, which is how an optimization of the
+# engine is checked against a library of recorded games; until= stops at any tick, which is how a long match is scrubbed
+# without watching it at FPS.
+class ReplayLog:
+    MAGIC, VERSION = b"SIQR", 2
+    HEADER, SPAWN, RECORD, DIGEST = struct.Struct("<4sBQIIHB"), struct.Struct("<iiI"), struct.Struct("<IHB"), 8
+    ARENA, RESPAWN = 1, 2  # header flags
+
+    def __init__(self, seed, snakes, size=DISPLAY_SIZE, arena=False, respawn=True, checkpoint_every=1000):
+        self.seed, self.checkpoint_every = seed, checkpoint_every
+        flags = (self.ARENA if arena else 0) | (self.RESPAWN if respawn else 0)
+        self.data = bytearray(self.HEADER.pack(self.MAGIC, self.VERSION, seed, *size, len(snakes), flags))
+        for snake in snakes: self.data += self.SPAWN.pack(*snake.elements[0], len(snake.elements))
+
+    def turn(self, tick, s_i, orientation):
+        self.data += self.RECORD.pack(tick, s_i, orientation.value)
+
+    def checkpoint(self, tick, digest):
+        self.data += self.RECORD.pack(tick, 0, 0)+digest
+
+    def save(self, path):
+        with open(path, "wb") as f: f.write(self.data)
+
+    @classmethod
+    def records(cls, data):
+        magic, version, seed, width, height, n_snakes, flags = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION: raise ValueError("not a SnakeIQ replay log")
+        at = cls.HEADER.size
+        spawns = [cls.SPAWN.unpack_from(data, at+i*cls.SPAWN.size) for i in range(n_snakes)]
+        yield seed, (width, height), spawns, flags
+        at += n_snakes*cls.SPAWN.size
+        while at < len(data):
+            tick, s_i, orientation = cls.RECORD.unpack_from(data, at)
+            at += cls.RECORD.size
+            if orientation: yield tick, s_i, Orientation(orientation), None
+            else: yield tick, s_i, None, bytes(data[at:at+cls.DIGEST]); at += cls.DIGEST
+
+
+def replay(data, until=None, verify=True):
+    if isinstance(data, str):
+        with open(data, "rb") as f: data = f.read()
+    records = ReplayLog.records(data)
+    seed, size, spawns, flags = next(records)
+    game = Game(headless=True, tick_rate=None, seed=seed, snakes=[Snake((x, y), length) for x, y, length in spawns],
+                size=size, arena=bool(flags & ReplayLog.ARENA), respawn=bool(flags & ReplayLog.RESPAWN))
+    for tick, s_i, orientation, digest in records:
+        if until is not None and tick > until: break
+        while game.ticks < tick and not game.game_over: game.step()  # turns of a tick are applied before it is stepped
+        if orientation is not None: game.turn(s_i, orientation)
+        elif verify and game.state_hash() != digest: raise RuntimeError(f"replay diverged by tick {tick}")
+    if until is not None:
+        while game.ticks < until and not game.game_over: game.step()
+    return game
 
 
 class Square(pygame.sprite.Sprite):
@@ -190,7 +788,682 @@ class Square(pygame.sprite.Sprite):
         self.rect = self.image.get_rect()
 
 
-pygame.init()
-game = Game()
-game.loop()
-print(game.reason)
+atlas = {}
+def square(length=BLOCK_SIZE, fill=LIGHT_BLUE):
+    # one pre-rendered Surface per colour and size for the whole process, instead of a new Surface per element per frame
+    key = (length, fill)
+    if key not in atlas: atlas[key] = Square(length, fill).image
+    return atlas[key]
+
+
+# The TextCache is the atlas for text: font.render() rasterises a string glyph by glyph every time it is called, so the
+# rendered Surfaces of one font are kept by (text, color, antialias), the least recently used evicted past size entries
+class TextCache:
+
+    def __init__(self, font, size=1024):
+        self.font, self.size = font, size
+        self.surfaces = OrderedDict()
+        self.hits = self.misses = 0
+
+    def render(self, text, color=WHITE, antialias=True):
+        key = (text, color, antialias)
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+            return surface
+        self.misses += 1
+        surface = self.surfaces[key] = self.font.render(text, antialias, color)
+        if len(self.surfaces) > self.size: self.surfaces.popitem(last=False)
+        return surface
+
+
+# A TileLayer draws a map under the game from a directory of OpenStreetMap-style tiles, root/zoom/x/y.png, standing in
+# for a tile server. Decoding a PNG takes milliseconds, far too long to do in a frame, so a tile goes through three
+# levels: a small LRU of ready Surfaces in memory, then a memory-mapped on-disk cache of decoded RGB tiles (a memcpy
+# away from a Surface, and still there on the next run), and only then the PNG, which a thread pool decodes into the
+# disk cache in the background. draw() only ever blits what is ready and a placeholder square for the rest, so panning
+# never waits on a tile; it also queues the tiles in a margin around the viewport, so that they are usually decoded
+# before the camera reaches them. origin is the tile at the top left of the world, so world pixels map onto tiles.
+class TileLayer:
+
+    def __init__(self, root, zoom, origin=(0, 0), tile=256, memory=256, cache="snakeiq.tiles", slots=512, margin=1,
+                 workers=2):
+        # the disk cache takes slots*tile*tile*3 bytes, about 100 MB for the default 512 tiles of 256 pixels
+        self.root, self.zoom, self.origin, self.tile, self.memory, self.margin = root, zoom, origin, tile, memory, margin
+        self.surfaces = OrderedDict()  # (x, y) -> Surface, or None for one missing or undecodable
+        self.executor = ThreadPoolExecutor(workers)
+        self.pending = {}  # (x, y) -> (slot, Future) of tiles being decoded
+        self.busy = set()  # the slots of the pending tiles, which no other tile may take until they are done
+        self.decoded = self.hits = self.misses = self.failed = 0
+        self.changed = False  # set when tiles arrived since the last draw(), which then has more to show
+
+        # the disk cache: slots decoded tiles, each with its (zoom, x, y) key, or -1 for a free slot; a key is written
+        # only after its pixels, so a crash mid-decode leaves the slot free rather than holding half a tile
+        shape = (slots, tile, tile, 3)
+        sizes = {cache+".rgb": np.prod(shape), cache+".keys": slots*3*4}  # int32 keys
+        mode = "r+" if all(os.path.exists(f) and os.path.getsize(f) == n for f, n in sizes.items()) else "w+"
+        self.rgb = np.memmap(cache+".rgb", dtype=np.uint8, mode=mode, shape=shape)
+        self.keys = np.memmap(cache+".keys", dtype=np.int32, mode=mode, shape=(slots, 3))
+        if mode == "w+": self.keys[:] = -1
+        self.disk = {(x, y): slot for slot, (z, x, y) in enumerate(self.keys.tolist()) if z == zoom}
+        free = np.flatnonzero(self.keys[:, 0] < 0)
+        self.next_slot = int(free[0]) if len(free) else 0  # slots are filled, then reused, round robin
+
+    def draw(self, screen, camera=(0, 0), area=None):
+        # the whole screen, prefetching around it, or only the tiles under area, a rectangle of the screen (a dirty
+        # cell), clipped to it; tiles that arrive in between are only taken in by whole draws, see changed
+        full = area is None
+        if full: self.poll()
+        left, top, w, h = screen.get_rect() if full else area
+        t, (ox, oy) = self.tile, self.origin
+        x0, y0, x1, y1 = (camera[0]+left)//t, (camera[1]+top)//t, (camera[0]+left+w-1)//t, (camera[1]+top+h-1)//t
+        placeholder = square(t, DARK_GREY)
+        screen.set_clip(area)
+        for y in range(y0, y1+1):
+            for x in range(x0, x1+1):
+                surface = self.get((ox+x, oy+y))
+                screen.blit(placeholder if surface is None else surface, (x*t-camera[0], y*t-camera[1]))
+        screen.set_clip(None)
+        if full:
+            m = self.margin
+            for y in range(y0-m, y1+m+1):
+                for x in range(x0-m, x1+m+1): self.get((ox+x, oy+y), ready=False)
+            self.changed = False
+
+    def get(self, key, ready=True):
+        # the Surface of a tile if it can be had without decoding, else None after queueing the decode
+        if key in self.surfaces:
+            if ready: self.hits += 1
+            self.surfaces.move_to_end(key)
+            return self.surfaces[key]
+        slot = self.disk.get(key)
+        if slot is None:
+            if key not in self.pending: self.decode(key)
+            if ready: self.misses += 1
+            return None
+        if not ready: return None  # already on disk; made into a Surface when it is drawn
+        surface = pygame.surfarray.make_surface(self.rgb[slot].swapaxes(0, 1))
+        self.remember(key, surface)
+        return surface
+
+    def path(self, key):
+        return os.path.join(self.root, str(self.zoom), str(key[0]), f"{key[1]}.png")
+
+    def decode(self, key):
+        # queues the PNG of key into the next slot no pending decode holds; a tile missing from the directory (off the
+        # map, or a gap in it) takes no slot and is remembered as None, and with every slot busy it is asked again later
+        if not os.path.exists(self.path(key)): return self.remember(key, None)
+        n = len(self.keys)
+        slot = next((s for s in (i % n for i in range(self.next_slot, self.next_slot+n)) if s not in self.busy), None)
+        if slot is None: return
+        self.next_slot = (slot+1) % n
+        evicted = tuple(self.keys[slot].tolist())
+        if evicted[0] == self.zoom and self.disk.get(evicted[1:]) == slot: del self.disk[evicted[1:]]
+        self.keys[slot] = -1
+        self.busy.add(slot)
+        self.pending[key] = (slot, self.executor.submit(self.load, key, slot))
+
+    def remember(self, key, surface):
+        self.surfaces[key] = surface
+        if len(self.surfaces) > self.memory: self.surfaces.popitem(last=False)
+
+    def load(self, key, slot):
+        # on a worker thread: the PNG into the slot of the disk cache
+        image = pygame.image.load(self.path(key))
+        if image.get_size() != (self.tile, self.tile): image = pygame.transform.smoothscale(image, (self.tile,)*2)
+        self.rgb[slot] = pygame.surfarray.array3d(image).swapaxes(0, 1)
+        self.keys[slot] = (self.zoom, *key)
+
+    def poll(self):
+        # moves the tiles decoded since the last call into the disk index, once their slot holds their key; a tile that
+        # failed to decode (a corrupt PNG) is remembered as None and drawn as the placeholder
+        for key, (slot, future) in list(self.pending.items()):
+            if not future.done(): continue
+            del self.pending[key]
+            self.busy.discard(slot)
+            if future.exception() is None and self.keys[slot].tolist() == [self.zoom, *key]:
+                self.disk[key] = slot
+                self.decoded += 1
+            else:
+                self.remember(key, None)
+                self.failed += 1
+            self.changed = True
+        return self.changed
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.poll()
+        self.rgb.flush()
+        self.keys.flush()
+
+
+# The SpatialHash is the generic collision half of the engine described in the header: any number of objects of any
+# kind, each an axis-aligned hit box (x, y, w, h) in pixels, and the question of which pairs touch on this tick. The
+# broadphase buckets every box into each uniform grid cell its extent covers (at most four cells when no box is larger
+# than a cell) and only boxes sharing a bucket become candidates, found by sorting the bucket keys once and comparing
+# neighbours; the narrowphase keeps the candidates whose hit boxes truly overlap. Everything is vectorized over all the
+# objects at once, so moving scenes of tens of thousands of asteroids or ants cost a sort rather than O(n²) pair tests.
+# events() then routes the pairs to per-kind-pair handlers in one call each, e.g. handlers[(SNAKE, FOOD)](snakes, foods)
+# which is the "what to do when certain pair-wise collisions occur" of a game built on top of the generic engine.
+class SpatialHash:
+
+    def __init__(self, cell=4*BLOCK_SIZE):
+        self.cell = cell  # pick about the size of the largest hit box; much smaller wastes buckets, much larger pairs
+
+    def pairs(self, boxes):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        n = len(boxes)
+        if n < 2: return np.empty((0, 2), dtype=np.int64)
+        x0, y0 = np.floor(boxes[:, 0]/self.cell).astype(np.int64), np.floor(boxes[:, 1]/self.cell).astype(np.int64)
+        x1 = np.floor((boxes[:, 0]+boxes[:, 2])/self.cell).astype(np.int64)
+        y1 = np.floor((boxes[:, 1]+boxes[:, 3])/self.cell).astype(np.int64)
+        nx = x1-x0+1
+        counts = nx*(y1-y0+1)
+
+        # broadphase: one (bucket, id) entry per covered cell, sorted by bucket so that sharing a bucket is adjacency
+        ids = np.repeat(np.arange(n), counts)
+        k = np.arange(len(ids))-np.repeat(np.cumsum(counts)-counts, counts)
+        keys = ((x0[ids]+k % nx[ids]) << 32) ^ ((y0[ids]+k//nx[ids]) & 0xFFFFFFFF)
+        order = np.argsort(keys, kind="stable")
+        keys, ids = keys[order], ids[order]
+        candidates = []
+        for d in range(1, len(keys)):  # buckets are contiguous, so no pair at distance d means none further apart
+            same = keys[d:] == keys[:-d]
+            if not same.any(): break
+            candidates.append(np.stack([ids[:-d][same], ids[d:][same]], axis=1))
+        if not candidates: return np.empty((0, 2), dtype=np.int64)
+        candidates = np.sort(np.concatenate(candidates), axis=1)
+        candidates = np.unique(candidates[:, 0]*n+candidates[:, 1])  # boxes sharing several buckets pair only once
+        a, b = candidates//n, candidates % n
+
+        # narrowphase: the hit boxes themselves overlap (touching edges do not count)
+        A, B = boxes[a], boxes[b]
+        hit = (A[:, 0] < B[:, 0]+B[:, 2]) & (B[:, 0] < A[:, 0]+A[:, 2]) & \
+              (A[:, 1] < B[:, 1]+B[:, 3]) & (B[:, 1] < A[:, 1]+A[:, 3])
+        return np.stack([a[hit], b[hit]], axis=1)
+
+    def events(self, boxes, kinds, handlers):
+        # handlers maps (kind_a, kind_b) to a function called once with the two arrays of object indices colliding
+        pairs = self.pairs(boxes)
+        kinds = np.asarray(kinds)
+        ka, kb = kinds[pairs[:, 0]], kinds[pairs[:, 1]]
+        swap = ka > kb  # so that handlers only need registering as (smaller kind, larger kind)
+        pairs[swap] = pairs[swap][:, ::-1]
+        ka, kb = np.minimum(ka, kb), np.maximum(ka, kb)
+        for (k_a, k_b), handler in handlers.items():
+            if k_a > k_b: k_a, k_b, swapped = k_b, k_a, True
+            else: swapped = False
+            match = pairs[(ka == k_a) & (kb == k_b)]
+            if len(match): handler(*((match[:, 1], match[:, 0]) if swapped else (match[:, 0], match[:, 1])))
+        return pairs
+
+
+# The EntityStore is the data layout for scenes of a hundred thousand objects per canvas, where an object per entity with
+# a __dict__ (and a Sprite and a Surface each, as Square has) costs hundreds of bytes and scatters the hot fields across
+# the heap. Each component (position, orientation, score, growth, sprite id, kind) is one dense array with a row per
+# live entity, removal swaps the last row into the hole so that the live rows stay packed, and the systems (move,
+# collide, draw) each sweep the packed rows in bulk with NumPy, the SpatialHash and one blits() per sprite. An Entity is
+# only a two-slot handle, id and store, whose properties read and write its row; ids stay valid across swaps. The store
+# is a standalone layer for games built on the generic engine: Game itself keeps its snakes in the OccupancyGrid and
+# per-snake deques, whose one lookup per head already is the bulk layout of its collision system, and Snake and Food
+# only gained __slots__.
+class Entity:
+    __slots__ = ("store", "id")
+
+    def __init__(self, store, id):
+        self.store, self.id = store, id
+
+    @property
+    def row(self):
+        return self.store.rows[self.id]
+
+    @property
+    def position(self):
+        return Coordinate(*self.store.position[self.row].tolist())
+
+    @position.setter
+    def position(self, at):
+        self.store.position[self.row] = at
+
+    @property
+    def orientation(self):
+        return Orientation(int(self.store.orientation[self.row]))
+
+    @orientation.setter
+    def orientation(self, orientation):
+        self.store.orientation[self.row] = orientation.value
+
+    @property
+    def score(self):
+        return int(self.store.score[self.row])
+
+    @score.setter
+    def score(self, score):
+        self.store.score[self.row] = score
+
+
+class EntityStore:
+    COMPONENTS = dict(position=(np.int32, (2,)), orientation=(np.int8, ()), score=(np.int32, ()),
+                      growth=(np.int32, ()), sprite=(np.int16, ()), kind=(np.int16, ()))
+
+    def __init__(self, capacity=1024, size=BLOCK_SIZE):
+        self.n, self.size = 0, size  # live rows, and the side of every hit box and sprite in pixels
+        for name, (dtype, width) in self.COMPONENTS.items():
+            setattr(self, name, np.zeros((capacity, *width) if width else capacity, dtype=dtype))
+        self.ids = np.zeros(capacity, dtype=np.int64)  # row -> entity id
+        self.rows = {}  # entity id -> row
+        self.next_id = 0
+        self.sprites = []  # sprite id -> (length, fill), drawn from the atlas
+
+    def add_sprite(self, fill, length=None):
+        key = (self.size if length is None else length, fill)
+        if key not in self.sprites: self.sprites.append(key)
+        return self.sprites.index(key)
+
+    def spawn(self, at, orientation=Orientation.EAST, kind=0, sprite=0, score=0):
+        if self.n == len(self.ids):  # grow every component by doubling, amortized O(1) per spawn
+            for name in (*self.COMPONENTS, "ids"):
+                old = getattr(self, name)
+                setattr(self, name, np.concatenate([old, np.zeros((max(1, len(old)), *old.shape[1:]), old.dtype)]))
+        row, id = self.n, self.next_id
+        self.position[row], self.orientation[row], self.kind[row], self.sprite[row] = at, orientation.value, kind, sprite
+        self.score[row] = score
+        self.growth[row] = 0
+        self.ids[row], self.rows[id] = id, row
+        self.n, self.next_id = self.n+1, self.next_id+1
+        return Entity(self, id)
+
+    def remove(self, entity):
+        row, last = self.rows.pop(entity.id), self.n-1
+        if row != last:
+            for name in (*self.COMPONENTS, "ids"): getattr(self, name)[row] = getattr(self, name)[last]
+            self.rows[int(self.ids[row])] = row
+        self.n -= 1
+
+    def move(self, step=BLOCK_SIZE):
+        self.position[:self.n] += STEPS[self.orientation[:self.n]]*step
+
+    def collide(self, handlers, spatial=None):
+        # handlers as for SpatialHash.events, called with arrays of entity ids rather than rows
+        n, spatial = self.n, SpatialHash(2*self.size) if spatial is None else spatial
+        boxes = np.empty((n, 4), dtype=np.float64)
+        boxes[:, :2], boxes[:, 2:] = self.position[:n], self.size
+        ids = self.ids[:n]
+        return ids[spatial.events(boxes, self.kind[:n], {k: (lambda a, b, h=h: h(ids[a], ids[b]))
+                                                          for k, h in handlers.items()})]
+
+    def draw(self, screen, camera=(0, 0)):
+        # only the rows inside the screen, one blits() per sprite
+        xy = self.position[:self.n]-np.asarray(camera, dtype=np.int32)
+        (w, h), margin = screen.get_size(), max((length for length, _ in self.sprites), default=self.size)
+        visible = (xy[:, 0] > -margin) & (xy[:, 0] < w) & (xy[:, 1] > -margin) & (xy[:, 1] < h)
+        xy, sprites = xy[visible].tolist(), self.sprite[:self.n][visible]
+        for sprite_id, (length, fill) in enumerate(self.sprites):
+            image = square(length, fill)
+            screen.blits([(image, xy[row]) for row in np.flatnonzero(sprites == sprite_id).tolist()], doreturn=False)
+
+
+
+# The BatchGame is the same SnakeIQ rules written for throughput instead of for legibility: N independent games of one
+# snake and one food each are held as NumPy arrays (head cells, orientation codes, a ring buffer of body cells per game,
+# an int8 board per game, food cells, scores) so that one call to step() advances every game in lockstep with a handful
+# of vectorized operations rather than a Python match and list surgery per snake. Cells here are grid units, not pixels
+# (multiply by BLOCK_SIZE to compare with Game). The rules mirror update_state and interpret_interactions exactly: move
+# the head, pop the tail unless growing, then a boundary crash, then a crash into any remaining body segment (so moving
+# into the cell the tail just left is legal), then eating. Finished games are frozen until reset() is called for them.
+# The board marks the head apart from the rest of the body, so that it alone is a complete observation of a game.
+EMPTY, BODY, FOOD, HEAD = 0, 1, 2, 3
+STEPS = np.array([(0, 0), (1, 0), (-1, 0), (0, -1), (0, 1)], dtype=np.int32)  # indexed by Orientation.value; 0 is stay
+OPPOSITE = np.array([0, 2, 1, 4, 3], dtype=np.int8)
+BOUNDARY, ITSELF, FULL = 1, 2, 3  # reason codes
+
+
+class BatchGame:
+    STATE = ("board", "body", "head", "lengths", "orientation", "growing", "scores", "food", "game_over", "reason",
+             "ticks")
+
+    def __init__(self, n_games, size=(DISPLAY_SIZE[0]//BLOCK_SIZE, DISPLAY_SIZE[1]//BLOCK_SIZE), length=3, seed=None):
+        self.n, self.size, self.length = n_games, size, length
+        self.capacity = size[0]*size[1]  # a snake can never be longer than the board, so the ring never overflows
+        self.rng = np.random.default_rng(seed)
+        self.ids = np.arange(n_games)
+
+        self.board = np.zeros((n_games, size[1], size[0]), dtype=np.int8)  # [game, y, x] of EMPTY, BODY, FOOD, HEAD
+        self.body = np.zeros((n_games, self.capacity, 2), dtype=np.int32)  # ring buffer of (x, y); head at self.head
+        self.head = np.zeros(n_games, dtype=np.int64)  # ring index of the head segment
+        self.lengths = np.zeros(n_games, dtype=np.int64)
+        self.orientation = np.zeros(n_games, dtype=np.int8)
+        self.growing = np.zeros(n_games, dtype=np.int64)
+        self.scores = np.zeros(n_games, dtype=np.int64)
+        self.food = np.zeros((n_games, 2), dtype=np.int32)
+        self.game_over = np.zeros(n_games, dtype=bool)
+        self.reason = np.zeros(n_games, dtype=np.int8)
+        self.ticks = np.zeros(n_games, dtype=np.int64)
+        self.reset()
+
+    def reset(self, mask=None):
+        g = self.ids if mask is None else np.flatnonzero(mask)
+        if len(g) == 0: return
+        self.board[g] = EMPTY
+        at = (2+self.length, 2)  # same spawn as Snake(): head at (40+length*BLOCK_SIZE, 40) pixels, facing east
+        segments = np.array([(at[0]-i, at[1]) for i in range(self.length)], dtype=np.int32)
+        self.body[g, :self.length] = segments[::-1]  # tail first so that the head sits at ring index length-1
+        self.head[g] = self.length-1
+        self.lengths[g] = self.length
+        self.board[g[:, None], segments[:, 1], segments[:, 0]] = BODY
+        self.board[g, at[1], at[0]] = HEAD
+        self.orientation[g] = Orientation.EAST.value
+        self.growing[g] = 0
+        self.scores[g] = self.length
+        self.game_over[g], self.reason[g], self.ticks[g] = False, 0, 0
+        self.spawn_food(g)
+
+    def spawn_food(self, g):
+        # same as Game.spawn_food(): a uniformly random empty cell, here the empty cell with the largest random key so
+        # that every eating game draws at once; a game whose board is full ends
+        if len(g) == 0: return
+        empty = (self.board[g] == EMPTY).reshape(len(g), -1)
+        cell = np.argmax(self.rng.random(empty.shape)*empty, axis=1)
+        full = ~empty.any(axis=1)
+        self.game_over[g[full]], self.reason[g[full]] = True, FULL
+        g, cell = g[~full], cell[~full]
+        self.food[g, 0], self.food[g, 1] = cell % self.size[0], cell//self.size[0]
+        self.board[g, self.food[g, 1], self.food[g, 0]] = FOOD
+
+    def heads(self):
+        return self.body[self.ids, self.head]
+
+    def step(self, orientations=None):
+        # orientations is an array of Orientation values per game (0 keeps the current one); reversals are ignored the
+        # same way interpret_events prevents humans from stupidly crashing into themselves
+        live = np.flatnonzero(~self.game_over)
+        if orientations is not None:
+            turn = np.asarray(orientations, dtype=np.int8)[live]
+            ok = (turn != 0) & (turn != OPPOSITE[self.orientation[live]])
+            self.orientation[live[ok]] = turn[ok]
+
+        # update_state: advance the head and pop the tail unless growing
+        head_is = self.body[live, self.head[live]]
+        head_to = head_is + STEPS[self.orientation[live]]
+        self.board[live, head_is[:, 1], head_is[:, 0]] = BODY  # before the pop, which may empty it again
+        growing = self.growing[live] > 0
+        self.growing[live[growing]] -= 1
+        popping = live[~growing]
+        tail = self.body[popping, (self.head[popping]-self.lengths[popping]+1) % self.capacity]
+        self.board[popping, tail[:, 1], tail[:, 0]] = EMPTY
+        self.lengths[live[growing]] += 1
+        self.head[live] = (self.head[live]+1) % self.capacity
+        self.body[live, self.head[live]] = head_to
+        self.ticks[live] += 1
+
+        # interpret_interactions: boundary, then itself, then food
+        x, y = head_to[:, 0], head_to[:, 1]
+        outside = (x < 0) | (x >= self.size[0]) | (y < 0) | (y >= self.size[1])
+        self.game_over[live[outside]], self.reason[live[outside]] = True, BOUNDARY
+        live, x, y = live[~outside], x[~outside], y[~outside]
+        cell = self.board[live, y, x]
+        itself = cell == BODY
+        self.game_over[live[itself]], self.reason[live[itself]] = True, ITSELF
+        eating = live[~itself & (x == self.food[live, 0]) & (y == self.food[live, 1])]
+        self.board[live[~itself], y[~itself], x[~itself]] = HEAD
+        self.growing[eating] += 1
+        self.scores[eating] += 1
+        self.spawn_food(eating)
+        return self.game_over
+
+    def snapshot(self):
+        return {k: getattr(self, k).copy() for k in self.STATE}
+
+    def restore(self, snapshot):
+        for k in self.STATE: getattr(self, k)[...] = snapshot[k]
+
+    def fork(self, games, k=1):
+        # a new BatchGame holding k copies of each of the given games, e.g. one copy per candidate move of a search node,
+        # so that every child of a tree search level is stepped in one vectorized call instead of one clone at a time
+        games = np.atleast_1d(games)
+        child = BatchGame.__new__(BatchGame)
+        child.n, child.size, child.length, child.capacity = len(games)*k, self.size, self.length, self.capacity
+        child.rng = self.rng.spawn(1)[0]  # an independent stream that leaves the parent's food spawns as they were
+        child.ids = np.arange(child.n)
+        for name in self.STATE: setattr(child, name, np.repeat(getattr(self, name)[games], k, axis=0))
+        return child
+
+    def reasons(self):
+        text = {BOUNDARY: "0 snake crashed into a boundary.", ITSELF: "0 snake crashed into itself.",
+                FULL: "the board is full."}
+        return [text.get(r) for r in self.reason.tolist()]
+
+
+# The SnakeVecEnv puts the BatchGame behind the reset()/step() API of a gymnasium vector environment, without depending
+# on gymnasium. The observation it returns is the engine's own board array, (num_envs, rows, columns) int8 of EMPTY,
+# BODY, FOOD and HEAD, not a copy built per step; likewise the reward, terminated and truncated arrays are reused every
+# step, so whatever must outlive the next step (a replay buffer) has to copy them, as replay buffers do anyway.
+# terminated is the engine's game_over: a crash into a boundary or into itself costs -1, each food eaten earns its
+# value, a full board ends the game with no penalty. Finished games are reset within the same step, their last board,
+# score and reason code being returned in the info dictionary, as gymnasium's autoreset does.
+class SnakeVecEnv:
+
+    def __init__(self, num_envs, size=(DISPLAY_SIZE[0]//BLOCK_SIZE, DISPLAY_SIZE[1]//BLOCK_SIZE), length=3, seed=None,
+                 max_ticks=None):
+        self.game = BatchGame(num_envs, size, length, seed)
+        self.num_envs, self.max_ticks = num_envs, max_ticks
+        self.scores = self.game.scores.copy()
+        self.rewards = np.zeros(num_envs, dtype=np.float32)
+        self.terminated = np.zeros(num_envs, dtype=bool)
+        self.truncated = np.zeros(num_envs, dtype=bool)
+
+    def reset(self, seed=None, options=None):
+        if seed is not None: self.game.rng = np.random.default_rng(seed)
+        self.game.reset()
+        self.scores[:] = self.game.scores
+        return self.game.board, {}
+
+    def step(self, actions):
+        game = self.game
+        game.step(actions)
+        self.rewards[:] = game.scores-self.scores
+        self.rewards[(game.reason == BOUNDARY) | (game.reason == ITSELF)] = -1.0  # only finished games have a reason
+        self.terminated[:] = game.game_over
+        if self.max_ticks: np.logical_and(game.ticks >= self.max_ticks, ~self.terminated, out=self.truncated)
+        done = self.terminated | self.truncated
+        info = {}
+        if done.any():
+            info = dict(done=np.flatnonzero(done), final_observation=game.board[done], final_score=game.scores[done],
+                        reason=game.reason[done])  # fancy indexing copies, before reset overwrites them
+            game.reset(done)
+        self.scores[:] = game.scores
+        return game.board, self.rewards, self.terminated, self.truncated, info
+
+
+
+# The PixelRenderer turns boards into RGB frames for pixel-based agents and video export without pygame or a display:
+# one preallocated uint8 frame buffer of (n, rows*block, columns*block, 3) is also viewed as (n, rows, block, width, 3),
+# so rasterising a batch of boards is one palette lookup per cell widened into a preallocated buffer of one pixel row
+# per board row, then copied into the block rows under it: two plain contiguous copies, instead of a 6-D broadcast of
+# every cell into its block that is ten times slower. Scores are stamped top left from a 3x5 digit font, again for all
+# the frames at once. render() returns the buffer itself, overwritten by the next render(), so copy frames that are
+# kept.
+PALETTE = np.array([BLACK, LIGHT_BLUE, LIGHT_YELLOW, LIGHT_BLUE], dtype=np.uint8)  # by EMPTY, BODY, FOOD, HEAD
+GLYPHS = np.array([[bit == "1" for bit in digit] for digit in (  # 0 to 9, five rows of three pixels each
+    "111101101101111", "010110010010111", "111001111100111", "111001111001111", "101101111001001",
+    "111100111001111", "111100111101111", "111001001001001", "111101111101111", "111101111001111")]).reshape(10, 5, 3)
+
+
+class PixelRenderer:
+
+    def __init__(self, n, size=(DISPLAY_SIZE[0]//BLOCK_SIZE, DISPLAY_SIZE[1]//BLOCK_SIZE), block=BLOCK_SIZE,
+                 digits=4, scale=2):
+        columns, rows = size
+        self.block, self.digits, self.scale = block, digits, scale
+        self.frames = np.zeros((n, rows*block, columns*block, 3), dtype=np.uint8)
+        self.lines = self.frames.reshape(n, rows, block, columns*block, 3)
+        self.row = np.zeros((n, rows, columns*block, 3), dtype=np.uint8)  # one pixel row per board row
+        self.cells = self.row.reshape(n, rows, columns, block, 3)
+        self.font = GLYPHS.repeat(scale, axis=1).repeat(scale, axis=2)  # (10, 5*scale, 3*scale)
+
+    def render(self, boards, scores=None):
+        self.cells[...] = PALETTE[boards][:, :, :, None]
+        self.lines[...] = self.row[:, :, None]
+        if scores is not None: self.stamp(np.asarray(scores))
+        return self.frames
+
+    def stamp(self, scores):
+        h, w = self.font.shape[1:]
+        for k in range(self.digits):
+            digit = scores//10**(self.digits-1-k) % 10
+            shown = (scores >= 10**(self.digits-1-k)) | (k == self.digits-1)  # no leading zeros
+            x = self.scale+k*(w+self.scale)
+            region = self.frames[:, self.scale:self.scale+h, x:x+w]
+            region[(self.font[digit] & shown[:, None, None])] = WHITE
+
+    def render_game(self, game):
+        # a Game of the object engine, as one frame of its board
+        return self.render(board_of(game)[None], [game.snakes[0].score])
+
+
+def board_of(game):
+    owners = np.frombuffer(game.grid.owners, dtype=np.int32).reshape(game.grid.rows, game.grid.columns)
+    board = np.where(owners >= 0, BODY, EMPTY).astype(np.int8)
+    for food in game.foods: board[food.at.lng//BLOCK_SIZE, food.at.lat//BLOCK_SIZE] = FOOD
+    for snake in game.snakes:
+        if not snake.alive: continue
+        head = snake.elements[0]
+        if game.grid.owner(head) >= 0: board[head.lng//BLOCK_SIZE, head.lat//BLOCK_SIZE] = HEAD
+    return board
+
+
+# The TickProfiler answers which phase used up the frame budget when a game stutters. Attached to a Game it times the
+# phases of every tick with perf_counter (a few hundred nanoseconds per tick, nothing at all when not attached), the
+# bookkeeping of end_tick (replay checkpoints hash the whole state) as a phase of its own, keeps the last window ticks
+# of per-phase durations in a ring, counts the ticks whose total went over the budget of one tick at the game's
+# tick_rate (FPS when it runs unthrottled, unless budget= says otherwise) and the frames the loop dropped to catch up,
+# and bins every tick's total in a power-of-two histogram of microseconds. summary() can be called at any time while the
+# game runs; with path= it is also written at exit.
+PHASES = ("interpret_events", "update_state", "interpret_interactions", "end_tick", "update_ui")
+
+
+class TickProfiler:
+
+    def __init__(self, budget=None, window=4096, path=None):
+        self.budget, self.window = budget, window  # seconds; None takes one tick of the game it is first stepped with
+        self.samples = [None]*window
+        self.ticks = self.over_budget = self.dropped = 0
+        self.histogram = [0]*40  # bucket i holds ticks lasting from 2**(i-1) up to 2**i microseconds
+        if path: atexit.register(self.dump, path)
+
+    def step(self, game, render):
+        if self.budget is None: self.budget = 1/(game.tick_rate or FPS)
+        clock = time.perf_counter
+        t0 = clock()
+        game.interpret_events()
+        t1 = clock()
+        game.update_state()
+        t2 = clock()
+        game.interpret_interactions()
+        t3 = clock()
+        game.end_tick()
+        t4 = clock()
+        if render: game.update_ui()
+        t5 = clock()
+        self.record((t1-t0, t2-t1, t3-t2, t4-t3, t5-t4), t5-t0)
+
+    def record(self, phases, total):
+        self.samples[self.ticks % self.window] = phases
+        self.ticks += 1
+        if total > self.budget: self.over_budget += 1
+        self.histogram[min(int(total*1e6).bit_length(), len(self.histogram)-1)] += 1
+
+    def summary(self):
+        rows = np.array(self.samples[:min(self.ticks, self.window)]).reshape(-1, len(PHASES))*1e3
+        def stats(ms): return dict(mean=float(ms.mean()), p50=float(np.median(ms)), p99=float(np.percentile(ms, 99)),
+                                   max=float(ms.max())) if len(ms) else {}
+        return dict(ticks=self.ticks, budget_ms=self.budget and self.budget*1e3, over_budget=self.over_budget, dropped=self.dropped,
+                    tick_ms=stats(rows.sum(axis=1)), phase_ms={p: stats(rows[:, i]) for i, p in enumerate(PHASES)},
+                    histogram_us={f"<{2**i}": n for i, n in enumerate(self.histogram) if n})
+
+    def dump(self, path):
+        with open(path, "w") as f: json.dump(self.summary(), f, indent=1)
+
+
+
+# The farm is how an AI policy is evaluated over a hundred thousand games: chunks of game indices are handed to a pool
+# of processes, each playing its chunk one headless Game after another at full speed, and each finished game writes its
+# row (seed, score, length, ticks survived, reason) straight into one results table living in shared memory that every
+# process maps; nothing but the chunk bounds and a count is ever pickled between processes, and the table can be read
+# while the farm is still running. brain is any picklable callable returning a Brain (a class works), called once per
+# chunk, so that a model is loaded once per chunk rather than once per game; game i and its brain (by Brain.reset) are
+# seeded with seed+i, so that any row is replayed from its seed alone.
+RESULT = np.dtype([("seed", "<i8"), ("score", "<i4"), ("length", "<i4"), ("ticks", "<i4"), ("reason", "S48")])
+farm_table = None
+
+
+def farm(n_games, brain=RandomBrain, processes=None, max_ticks=10_000, seed=0, chunk=64):
+    raw = multiprocessing.RawArray("b", RESULT.itemsize*n_games)  # shared memory, inherited by the pool's processes
+    table = np.frombuffer(raw, dtype=RESULT, count=n_games)
+    chunks = [(start, min(start+chunk, n_games), brain, max_ticks, seed) for start in range(0, n_games, chunk)]
+    with multiprocessing.Pool(processes, initializer=farm_attach, initargs=(raw, n_games)) as pool:
+        for _ in pool.imap_unordered(farm_chunk, chunks): pass
+    return table.copy()
+
+
+def farm_attach(raw, n_games):
+    global farm_table
+    farm_table = np.frombuffer(raw, dtype=RESULT, count=n_games)
+
+
+def farm_chunk(args):
+    start, stop, brain, max_ticks, seed = args
+    b = brain()
+    for i in range(start, stop):
+        b.reset(seed+i)
+        game = Game(headless=True, tick_rate=None, seed=seed+i, snakes=[Snake(brain=b)])
+        game.loop(max_ticks)
+        snake = game.snakes[0]
+        farm_table[i] = (seed+i, snake.score, len(snake.elements), game.ticks, (game.reason or "").encode()[:48])
+    return stop-start
+
+
+# The benchmark is the reproducible answer to where the engine saturates: every combination of board size, number of
+# snakes, snake length and headless or rendered mode plays a fixed number of ticks (restoring the starting snapshot
+# whenever the game ends, so that the load stays constant) with RandomBrain snakes laid out in lanes, timing each of the
+# four phases of a tick separately with a TickProfiler. One JSON object per combination is appended to path together
+# with the commit and library versions, so that two runs on two commits compare line by line. Rendered mode needs a
+# display; on servers set SDL_VIDEODRIVER=dummy. python sandbox.000001.game.snakeiq.py benchmark [path] runs the default
+# matrix.
+def benchmark(path="snakeiq.benchmark.jsonl", sizes=((640, 480), (1280, 960), (2560, 1920)), snakes=(1, 16, 128),
+              lengths=(3, 24, 96), modes=("headless", "rendered"), ticks=500, seed=0):
+    try: commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError: commit = None
+    with open(path, "a") as f:
+        for size, n_snakes, length, mode in itertools.product(sizes, snakes, lengths, modes):
+            lanes = [(x, y) for y in range(BLOCK_SIZE, size[1]-BLOCK_SIZE, 2*BLOCK_SIZE)
+                     for x in range(length*BLOCK_SIZE, size[0]-BLOCK_SIZE, (length+1)*BLOCK_SIZE)]
+            if len(lanes) < n_snakes: continue  # does not fit on this board
+            brain = RandomBrain(seed)
+            game = Game(headless=mode == "headless", tick_rate=None, seed=seed, size=size,
+                        snakes=[Snake(at, length, brain) for at in lanes[:n_snakes]])
+            game.profiler = TickProfiler(window=ticks)
+            start = game.snapshot()
+            began = time.perf_counter()
+            for _ in range(ticks):
+                if game.game_over: game.restore(start)
+                game.step(render=not game.headless)
+            seconds = time.perf_counter()-began
+            phases = game.profiler.summary()["phase_ms"]
+            row = dict(commit=commit, python=sys.version.split()[0], pygame=pygame.version.ver, numpy=np.__version__,
+                       size=size, snakes=n_snakes, length=length, mode=mode, ticks=ticks, seconds=seconds,
+                       ticks_per_second=ticks/seconds, phase_us={k: 1e3*v["mean"] for k, v in phases.items()})
+            f.write(json.dumps(row)+"\n")
+            f.flush()
+            print(f"{size[0]}x{size[1]} snakes={n_snakes} length={length} {mode}: {row['ticks_per_second']:.0f} ticks/s")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["benchmark"]:
+        benchmark(*sys.argv[2:3])
+    else:
+        game = Game()
+        game.loop()
+        print(game.reason)
@@ -1,4 +1,5 @@
-import websockets  # requires pip install
+from collections import deque
+import websockets  # requires pip install, version 14 or later
 import asyncio
 import random
 import json
@@ -9,10 +10,11 @@ import json
 # streaming data one or both ways, from one server potentially sending, broadcasting, and receiving to multiple clients.
 # Here we simulate a game engine or content streaming provider that maintains a state (instruction) here on the server,
 # and periodically broadcasts that set of state to all its connected clients (once every approximately 0.01 seconds),
-# i.e., at about 100 FPS. (It does not contain any optimizations: the state is broadcast again even when the state does
-# not change, the entire state is braodcast even when incremental changes of state would be sufficient, etc., but then
+# i.e., at about 100 FPS. (It started without any optimizations: the state was broadcast again even when the state did
+# not change, the entire state was broadcast even when incremental changes of state would be sufficient, etc., but then
 # again, managing whether a client has gone off the rails and changed its state in the browser JS is itself an unknown,
-# so preserving the 'one state, pave over it all' perspective is itself a design choice.) The key insight here is how
+# so preserving the 'one state, pave over it all' perspective is itself a design choice; the Scene below keeps it as
+# the keyframe a client falls back to, and otherwise sends only what changed.) The key insight here is how
 # the use of the canvas allows the render to be reduced to a small dictionary of parameters for each element, which is
 # for all intents and purposes very simple, extendable, and very fast in modern contexts, so gets you very far for cases
 # in which the render is essential but not the whole innovation. The other key insight here is how algorithmic the JS
@@ -44,51 +46,148 @@ def generate_random_items():
     to_render = []
     for i in range(n_items):
         xy = [random.uniform(0, 640-10), random.uniform(0, 400-10)]
-        to_render.append(dict(type="RECTANGLE", into="PRIMARY", fid="fBLOCK_{i}", xy=xy, args=[10, 10, "white"]))
+        to_render.append(dict(type="RECTANGLE", into="PRIMARY", fid=f"BLOCK_{i}", xy=xy, args=[10, 10, "white"]))
     to_render.append(dict(type="TEXT", into="PRIMARY", fid="COUNT", xy=(260, 160), args=[f"n_items={n_items}", "left", "20px", "white"]))
     return to_render
 
 
-instructions = generate_random_items()
+# The Scene holds the instructions by fid and numbers every change to them with a version, keeping a log of which fids
+# each of the last history versions touched. A client acknowledges each version it has applied, and is then sent only
+# the instructions added or changed and the fids removed since that version: a delta whose size follows the rate of
+# change rather than the size of the scene, and nothing at all while the scene stands still. A delta is valid on top of
+# any version from its base onward, so a client that acknowledged late is still right; whenever fids were added, removed
+# or moved, it also carries the whole drawing order of fids, so that a client drawing from deltas paints the same
+# picture as one drawing from a keyframe. A client that has nothing, or a base older than the log, or that reports it
+# lost track (message browser_id.KEYFRAME), is sent a keyframe of the whole scene, which the JS paints over everything
+# it had.
+class Scene:
+
+    def __init__(self, instructions=(), history=1024):
+        self.version = 0
+        self.instructions = {}  # fid -> instruction, in drawing order
+        self.log = deque(maxlen=history)  # (version, fids it added, changed or removed, whether the order changed)
+        self.changed = asyncio.Event()  # set whenever some client is out of date: a new version, a join, a lost track
+        self.update(instructions)
+
+    def update(self, instructions):
+        # replaces the whole scene, diffing by fid, so that producers need not track what they changed
+        new = {instruction["fid"]: instruction for instruction in instructions}
+        changed = [fid for fid, instruction in new.items() if self.instructions.get(fid) != instruction]
+        changed += [fid for fid in self.instructions if fid not in new]
+        reordered = list(new) != list(self.instructions)  # membership or order; an added fid need not go last
+        self.instructions = new
+        if not changed and not reordered: return self.version
+        self.version += 1
+        self.log.append((self.version, changed, reordered))
+        self.changed.set()
+        return self.version
+
+    def delta(self, base=None):
+        oldest = self.log[0][0] if self.log else self.version+1
+        if base is None or not oldest-1 <= base <= self.version:
+            return dict(version=self.version, base=None, instructions=list(self.instructions.values()), removed=[])
+        fids, reordered = {}, False
+        for version, changed, order in reversed(self.log):
+            if version <= base: break
+            fids.update(dict.fromkeys(changed))
+            reordered |= order
+        delta = dict(version=self.version, base=base, removed=[fid for fid in fids if fid not in self.instructions],
+                     instructions=[self.instructions[fid] for fid in fids if fid in self.instructions])
+        if reordered: delta["order"] = list(self.instructions)  # the drawing order, which the client rebuilds
+        return delta
+
+
+scene = Scene(generate_random_items())
+clients = {}  # websocket -> dict(acked=version the client last applied, sent=version last queued for it, queue=frames)
+commands = asyncio.Queue()  # (websocket, browser_id, key, args) of every inbound command, from every connection
+
+
+# The broadcaster is the one place frames are made, and the tick clock of the server: whenever something changed, at
+# most once per tick, it walks the clients whose scene is out of date and encodes one delta per distinct acknowledged
+# base, to UTF-8 bytes, shared by every client at that base; with clients keeping up that is one or two json.dumps per
+# tick however many are connected, instead of one per client, and while nothing changes it sleeps. The bytes go onto
+# each client's own bounded send queue, drained by its connection, so a slow client never holds up the others; when
+# its queue is full the oldest frame is dropped, which loses nothing since every delta is taken from the acknowledged
+# version and so already holds everything the frames before it did.
+async def broadcaster(interval=0.01):
+    while True:
+        await scene.changed.wait()
+        scene.changed.clear()
+        broadcast()
+        await asyncio.sleep(interval)
+
+
+def broadcast():
+    frames = {}  # base version -> the encoded frame taking a client from it to the current version
+    for client in clients.values():
+        if client["sent"] == scene.version: continue
+        base = client["acked"]
+        if base not in frames:
+            data = dict(assets=[], **scene.delta(base))
+            frames[base] = json.dumps(dict(message=f"update gameplay", data=data)).encode()
+        if client["queue"].full(): client["queue"].get_nowait()
+        client["queue"].put_nowait(frames[base])
+        client["sent"] = scene.version
+
+
+# The commander applies the commands of all the connections one at a time, in the order they arrived, as soon as they
+# arrive: it is the only code that changes the scene, so game logic never races itself across connections.
+async def commander():
+    while True:
+        websocket, browser_id, key, args = await commands.get()
+        if key == "KEYFRAME" and websocket in clients:  # the client lost track; the next message is the whole scene
+            clients[websocket]["acked"] = clients[websocket]["sent"] = None
+            scene.changed.set()
+        if key == "R":  # the key of the button, whether R or ESCAPE is pressed, or the button itself is clicked.
+            scene.update(generate_random_items())  # generate new items
 
 
 async def producer_handler(websocket):
-    while True:
-        data = dict(assets=[], instructions=instructions)  # get the global variable holding instructions
-        await websocket.send(json.dumps(dict(message=f"update gameplay", data=data)))
-        try: await asyncio.wait_for(consumer_handler(websocket), timeout=0.01)
-        except TimeoutError: pass
-        except Exception as e: raise RuntimeError(e)
+    # the writer: sleeps on the send queue until the broadcaster puts a frame on it
+    queue = clients[websocket]["queue"]
+    try:
+        while True: await websocket.send(await queue.get(), text=True)  # bytes as a text frame, as is
+    except websockets.ConnectionClosed: return
 
 
 async def consumer_handler(websocket):
-    message = await websocket.recv()
-    print(f"Received: {message}")
+    # the reader: one long-lived task per connection, woken only by inbound messages, which it never loses to a timeout
     try:
-        browser_id, key = message.split(".")
-        if key == "R":  # the key of the button, whether R or ESCAPE is pressed, or the button itself is clicked.
-            global instructions
-            instructions = generate_random_items()  # generate new items
-    except Exception as e:
-        return
-
-
-# When a user connects to ws://localhost:8765 the handler is enacted to send the welcome message, which is used here
-# to pass 'construction' information on how the JS can add HTML elements via divs, canvas, buttons. It constructs once.
-# Then, producer_handler begins, which simply waits for timeout=0.01 seconds to identity whether any inbound websocket
-# message was received (i.e., a message of any button press). Regardless of whether a message was received or not, the
-# producer_handler broadcasts its present state of elements which should be rendered (which we refer to as instructions)
-# to show that the communication can be structured as a set of machine instructions for remote execution; our internal
-# websockets communication channel expects logging of each instruction action, its failures, and communication of those
-# back to the source, i.e., like assembly. This is a benefit of the structured instruction rendering code model here.
+        async for message in websocket:
+            try: browser_id, key, *args = message.split(".")
+            except (AttributeError, ValueError): continue  # not a command
+            if key == "ACK":  # the version the client has applied, the base of the next delta sent to it
+                if args and args[0].isdigit(): clients[websocket]["acked"] = int(args[0])
+                continue
+            print(f"Received: {message}")
+            commands.put_nowait((websocket, browser_id, key, args))
+    except websockets.ConnectionClosed: return
+
+
+# When a user connects to ws://localhost:8765 the handler is enacted to send the welcome message, which is used here to
+# pass 'construction' information on how the JS can add HTML elements via divs, canvas, buttons. It constructs once.
+# Then two tasks run side by side for as long as the connection lasts: consumer_handler reads every inbound websocket
+# message (i.e., a message of any button press) the moment it arrives and queues it for the commander, while
+# producer_handler sends whatever changed in the present state of elements which should be rendered (which we refer to
+# as instructions) as the broadcaster queues it; an idle connection is two sleeping tasks. This shows that the
+# communication can be structured as a set of machine instructions for remote execution; our internal websockets
+# communication channel expects logging of each instruction action, its failures, and communication of those back to
+# the source, i.e., like assembly. This is a benefit of the structured instruction rendering code model here.
 async def handler(websocket):
     await websocket.send(json.dumps(dict(message="Welcome to the game.", data=construction)))
-    await producer_handler(websocket)
+    clients[websocket] = dict(acked=None, sent=None, queue=asyncio.Queue(maxsize=4))  # a keyframe first
+    scene.changed.set()
+    tasks = [asyncio.create_task(consumer_handler(websocket)), asyncio.create_task(producer_handler(websocket))]
+    try: await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)  # the connection closed, seen by either
+    finally:
+        for task in tasks: task.cancel()
+        clients.pop(websocket, None)
 
 
 async def main():
     async with websockets.serve(handler, "localhost", 8765) as server:
         print("starting service on port 8765")
+        tasks = [asyncio.create_task(broadcaster()), asyncio.create_task(commander())]  # referenced, held weakly
         await server.serve_forever()
 
 